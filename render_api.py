@@ -5,20 +5,34 @@ Combina video + audio usando FFmpeg
 """
 
 import os
-import uuid
+import stat
+import hashlib
+import secrets
 import asyncio
+import time
 import subprocess
 import logging
 from pathlib import Path
 from typing import Optional, Dict, Any
 from datetime import datetime
 import json
+import heapq
+import tempfile
 import psutil
 import aiofiles
-import requests
+import aiofiles.os
+import aiohttp
+from cachetools import TTLCache
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
+
+try:
+    import av
+except ImportError:  # PyAV es opcional: sin él todos los renders usan el proceso ffmpeg
+    av = None
 
 from fastapi import FastAPI, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
 from pydantic import BaseModel, HttpUrl
 
 # Configuración de logging
@@ -37,11 +51,59 @@ FFMPEG_THREADS = int(os.getenv('FFMPEG_THREADS', '3'))
 MAX_CONCURRENT_JOBS = int(os.getenv('MAX_CONCURRENT_JOBS', '2'))
 TEMP_DIR = Path(os.getenv('TEMP_DIR', '/tmp/ffmpeg'))
 OUTPUT_DIR = Path(os.getenv('OUTPUT_DIR', '/app/output'))
+ENCODER = os.getenv('ENCODER', 'auto')  # auto, libx264, nvenc, qsv, vaapi
+VAAPI_DEVICE = os.getenv('VAAPI_DEVICE', '/dev/dri/renderD128')
+REDIS_URL = os.getenv('REDIS_URL', '')
+JOB_TTL_SECONDS = int(os.getenv('JOB_TTL_SECONDS', '86400'))
+MAX_STORED_JOBS = int(os.getenv('MAX_STORED_JOBS', '10000'))
+X_ACCEL_REDIRECT_PREFIX = os.getenv('X_ACCEL_REDIRECT_PREFIX', '').rstrip('/')
+JOB_LOCK_TTL_SECONDS = int(os.getenv('JOB_LOCK_TTL_SECONDS', '7200'))
+TEMP_FILE_MAX_AGE_HOURS = float(os.getenv('TEMP_FILE_MAX_AGE_HOURS', '6'))
+STREAM_INPUTS = os.getenv('STREAM_INPUTS', 'false').lower() in ('1', 'true', 'yes')
+FRAGMENTED_MP4 = os.getenv('FRAGMENTED_MP4', 'false').lower() in ('1', 'true', 'yes')
+
+# MP4 fragmentado: el moov va al inicio sin reescribir el archivo al terminar (+faststart)
+MP4_MOVFLAGS = "+frag_keyframe+empty_moov+default_base_moof" if FRAGMENTED_MP4 else "+faststart"
 
 # Crear directorios si no existen
 TEMP_DIR.mkdir(parents=True, exist_ok=True)
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
+# Configuración de calidad por encoder
+ENCODER_SETTINGS = {
+    "libx264": {
+        "high": ["-c:v", "libx264", "-crf", "18", "-preset", "medium"],
+        "medium": ["-c:v", "libx264", "-crf", "23", "-preset", "fast"],
+        "low": ["-c:v", "libx264", "-crf", "28", "-preset", "ultrafast"]
+    },
+    "nvenc": {
+        "high": ["-c:v", "h264_nvenc", "-preset", "p5", "-cq", "19"],
+        "medium": ["-c:v", "h264_nvenc", "-preset", "p4", "-cq", "23"],
+        "low": ["-c:v", "h264_nvenc", "-preset", "p1", "-cq", "28"]
+    },
+    "qsv": {
+        "high": ["-c:v", "h264_qsv", "-preset", "slow", "-global_quality", "19"],
+        "medium": ["-c:v", "h264_qsv", "-preset", "medium", "-global_quality", "23"],
+        "low": ["-c:v", "h264_qsv", "-preset", "veryfast", "-global_quality", "28"]
+    },
+    "vaapi": {
+        "high": ["-vf", "format=nv12,hwupload", "-c:v", "h264_vaapi", "-qp", "19"],
+        "medium": ["-vf", "format=nv12,hwupload", "-c:v", "h264_vaapi", "-qp", "23"],
+        "low": ["-vf", "format=nv12,hwupload", "-c:v", "h264_vaapi", "-qp", "28"]
+    }
+}
+
+# Presets de libx264, del más rápido al más lento
+X264_PRESETS = [
+    "ultrafast", "superfast", "veryfast", "faster", "fast",
+    "medium", "slow", "slower", "veryslow"
+]
+
+# Opciones globales que algunos encoders necesitan antes de las entradas
+ENCODER_INPUT_ARGS = {
+    "vaapi": ["-vaapi_device", VAAPI_DEVICE]
+}
+
 # FastAPI app
 app = FastAPI(
     title="Video Render API",
@@ -49,9 +111,57 @@ app = FastAPI(
     version="1.0.0"
 )
 
-# Estado global de trabajos
-jobs_status: Dict[str, Dict[str, Any]] = {}
-active_jobs = 0
+# Estado global de trabajos (se usa Redis si REDIS_URL está configurado)
+# Todo el acceso ocurre en el event loop, así que TTLCache no necesita lock
+jobs_status: TTLCache = TTLCache(maxsize=MAX_STORED_JOBS, ttl=JOB_TTL_SECONDS)
+redis_client: Optional[aioredis.Redis] = None
+
+# Cola de trabajos: como máximo MAX_CONCURRENT_JOBS en ejecución por proceso
+JOB_SEM = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
+queued_jobs = 0
+
+# Trabajos pendientes o en ejecución, para unir peticiones duplicadas
+# (con Redis se usa un lock por trabajo, compartido entre workers)
+inflight_jobs: set = set()
+
+# Operaciones sobre el lock solo si sigue perteneciendo a quien lo reservó (token)
+REFRESH_CLAIM_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_CLAIM_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Descargas grandes en partes paralelas con peticiones Range
+RANGE_DOWNLOAD_THRESHOLD = 16 * 1024 * 1024
+RANGE_DOWNLOAD_PARTS = 4
+
+# Pool de buffers para agrupar escrituras de las descargas (2 archivos por trabajo, en partes).
+# Cada buffer acumula 1 MiB antes de escribir, para pocas escrituras en el thread pool.
+# aiohttp sigue creando un bytes por lectura: el pool solo reutiliza el buffer de escritura
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+BUFFER_POOL: asyncio.Queue = asyncio.Queue()
+for _ in range(MAX_CONCURRENT_JOBS * 2 * RANGE_DOWNLOAD_PARTS):
+    BUFFER_POOL.put_nowait(bytearray(DOWNLOAD_BUFFER_SIZE))
+
+# Tarea periódica que expira trabajos en memoria
+expire_task: Optional[asyncio.Task] = None
+
+# Sesión HTTP compartida (se crea en el evento de startup)
+http_session: Optional[aiohttp.ClientSession] = None
+
+# Encoder de video seleccionado y versión de FFmpeg (se detectan en el evento de startup)
+video_encoder = "libx264"
+ffmpeg_version = "Unknown"
+
+# Remux en proceso con PyAV (se verifica en el evento de startup)
+inprocess_remux = False
 
 class RenderRequest(BaseModel):
     video_url: HttpUrl
@@ -68,12 +178,140 @@ class JobStatus(BaseModel):
     output_file: Optional[str] = None
     error: Optional[str] = None
 
+@app.on_event("startup")
+async def startup_event():
+    """Inicializar recursos compartidos"""
+    global http_session, video_encoder, ffmpeg_version, inprocess_remux, redis_client, expire_task
+    # Conexiones keep-alive reutilizables y DNS en caché entre descargas
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=64, keepalive_timeout=60, ttl_dns_cache=300)
+    )
+    if REDIS_URL:
+        redis_client = aioredis.from_url(REDIS_URL, decode_responses=True)
+        logger.info("Job state stored in Redis")
+    else:
+        expire_task = asyncio.create_task(expire_jobs_periodically())
+    
+    # Primera muestra de CPU para que las lecturas no bloqueantes de /health tengan referencia.
+    # psutil guarda la referencia por hilo: debe ejecutarse en el hilo del event loop
+    psutil.cpu_percent(interval=None)
+    
+    # La versión no cambia mientras el proceso vive: consultarla una sola vez
+    video_encoder, ffmpeg_version, inprocess_remux, _ = await asyncio.gather(
+        detect_video_encoder(),
+        asyncio.to_thread(get_ffmpeg_version),
+        asyncio.to_thread(check_inprocess_remux),
+        cleanup_orphan_temp_files()
+    )
+    logger.info(f"Video encoder: {video_encoder}")
+    logger.info(f"In-process remux: {'enabled' if inprocess_remux else 'disabled'}")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Liberar recursos compartidos"""
+    if http_session is not None:
+        await http_session.close()
+    if redis_client is not None:
+        await redis_client.aclose()
+    if expire_task is not None:
+        expire_task.cancel()
+
+async def expire_jobs_periodically(interval: int = 60):
+    """Expirar trabajos en memoria aunque nadie acceda a la caché"""
+    while True:
+        await asyncio.sleep(interval)
+        jobs_status.expire()
+
+async def save_job(job_id: str, fields: Dict[str, Any]):
+    """Guardar campos de un trabajo"""
+    if redis_client is None:
+        # Reasignar (no mutar) para que TTLCache renueve la expiración, igual que Redis
+        jobs_status[job_id] = {**jobs_status.get(job_id, {}), **fields}
+        return
+    
+    key = f"job:{job_id}"
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(key, mapping={k: json.dumps(v) for k, v in fields.items()})
+        pipe.expire(key, JOB_TTL_SECONDS)
+        await pipe.execute()
+
+async def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """Obtener un trabajo por su ID"""
+    if redis_client is None:
+        return jobs_status.get(job_id)
+    
+    data = await redis_client.hgetall(f"job:{job_id}")
+    return {k: json.loads(v) for k, v in data.items()} if data else None
+
+async def get_all_jobs() -> list:
+    """Obtener todos los trabajos registrados"""
+    if redis_client is None:
+        return list(jobs_status.values())
+    
+    keys = [key async for key in redis_client.scan_iter(match="job:*")]
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.hgetall(key)
+        results = await pipe.execute()
+    
+    return [{k: json.loads(v) for k, v in data.items()} for data in results if data]
+
+async def claim_job(job_id: str) -> Optional[str]:
+    """Marcar un trabajo como en curso; devuelve el token de la reserva o None si ya lo estaba"""
+    token = secrets.token_hex(8)
+    
+    if redis_client is None:
+        # Sin await entre la comprobación y el add: atómico dentro del event loop
+        if job_id in inflight_jobs:
+            return None
+        inflight_jobs.add(job_id)
+        return token
+    
+    claimed = await redis_client.set(f"lock:{job_id}", token, nx=True, ex=JOB_LOCK_TTL_SECONDS)
+    return token if claimed else None
+
+async def refresh_job_claim(job_id: str, token: str) -> bool:
+    """Renovar la expiración de la reserva; False si ya no es nuestra"""
+    if redis_client is None:
+        return True
+    
+    return bool(await redis_client.eval(REFRESH_CLAIM_SCRIPT, 1, f"lock:{job_id}", token, JOB_LOCK_TTL_SECONDS))
+
+async def keep_job_claim(job_id: str, token: str):
+    """Renovar la reserva periódicamente mientras el trabajo espera en cola y se ejecuta"""
+    if redis_client is None:
+        return
+    
+    while True:
+        await asyncio.sleep(JOB_LOCK_TTL_SECONDS / 3)
+        try:
+            if not await refresh_job_claim(job_id, token):
+                logger.warning(f"Lost claim on job {job_id}")
+                return
+        except RedisError as e:
+            logger.warning(f"Failed to refresh claim on job {job_id}: {e}")
+
+async def release_job_claim(job_id: str, token: str):
+    """Liberar la marca de trabajo en curso, solo si sigue siendo nuestra"""
+    if redis_client is None:
+        inflight_jobs.discard(job_id)
+    else:
+        await redis_client.eval(RELEASE_CLAIM_SCRIPT, 1, f"lock:{job_id}", token)
+
+def count_active_jobs() -> int:
+    """Número de trabajos en ejecución en este proceso"""
+    return MAX_CONCURRENT_JOBS - JOB_SEM._value
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    cpu_percent = psutil.cpu_percent(interval=1)
-    memory = psutil.virtual_memory()
-    disk_usage = psutil.disk_usage(str(OUTPUT_DIR))
+    # interval=None no bloquea (lee /proc/stat) y usa el delta desde la llamada
+    # anterior en este mismo hilo, así que no se delega a un thread
+    cpu_percent = psutil.cpu_percent(interval=None)
+    memory, disk_usage = await asyncio.gather(
+        asyncio.to_thread(psutil.virtual_memory),
+        asyncio.to_thread(psutil.disk_usage, str(OUTPUT_DIR))
+    )
     
     return {
         "status": "healthy",
@@ -82,10 +320,13 @@ async def health_check():
             "cpu_usage": f"{cpu_percent}%",
             "memory_usage": f"{memory.percent}%",
             "disk_free": f"{disk_usage.free // (1024**3)}GB",
-            "active_jobs": active_jobs,
+            "active_jobs": count_active_jobs(),
+            "queued_jobs": queued_jobs,
             "max_jobs": MAX_CONCURRENT_JOBS
         },
-        "ffmpeg_version": get_ffmpeg_version()
+        "video_encoder": video_encoder,
+        "inprocess_remux": inprocess_remux,
+        "ffmpeg_version": ffmpeg_version
     }
 
 def get_ffmpeg_version():
@@ -101,95 +342,232 @@ def get_ffmpeg_version():
     except Exception:
         return "FFmpeg not available"
 
+async def detect_video_encoder() -> str:
+    """Detectar encoder H.264 por hardware disponible"""
+    if ENCODER != "auto":
+        if ENCODER not in ENCODER_SETTINGS:
+            logger.warning(f"Unknown ENCODER '{ENCODER}', falling back to libx264")
+            return "libx264"
+        return ENCODER
+    
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-hide_banner", "-encoders",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        stdout, _ = await process.communicate()
+    except Exception:
+        return "libx264"
+    
+    available = stdout.decode('utf-8', errors='replace')
+    
+    for encoder in ("nvenc", "qsv", "vaapi"):
+        # Que FFmpeg lo incluya no garantiza que exista el hardware: probar un frame
+        if f"h264_{encoder}" in available and await test_video_encoder(encoder):
+            return encoder
+    
+    return "libx264"
+
+async def test_video_encoder(encoder: str) -> bool:
+    """Comprobar que un encoder funciona codificando un frame de prueba"""
+    cmd = [
+        "ffmpeg", "-hide_banner", "-v", "error",
+        *ENCODER_INPUT_ARGS.get(encoder, []),
+        "-f", "lavfi", "-i", "color=size=256x256:rate=1",
+        "-frames:v", "1",
+        *ENCODER_SETTINGS[encoder]["medium"],
+        "-f", "null", "-"
+    ]
+    
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+    except Exception:
+        return False
+    
+    try:
+        return await asyncio.wait_for(process.wait(), timeout=10) == 0
+    except asyncio.TimeoutError:
+        process.kill()
+        return False
+
 @app.post("/render")
 async def create_render_job(request: RenderRequest, background_tasks: BackgroundTasks):
     """Crear nuevo trabajo de renderizado"""
-    global active_jobs
-    
-    # Verificar límite de trabajos concurrentes
-    if active_jobs >= MAX_CONCURRENT_JOBS:
-        raise HTTPException(
-            status_code=429, 
-            detail=f"Maximum concurrent jobs ({MAX_CONCURRENT_JOBS}) reached. Try again later."
-        )
+    # El ID depende del contenido: la misma petición produce el mismo archivo de salida
+    job_id = get_render_key(request)
+    output_file = OUTPUT_DIR / f"render_{job_id}.mp4"
     
-    # Generar ID único para el trabajo
-    job_id = str(uuid.uuid4())[:8]
+    # Reservar el ID antes de cualquier otro await: una petición idéntica aún en
+    # curso devuelve el trabajo existente
+    claim_token = await claim_job(job_id)
+    if claim_token is None:
+        logger.info(f"Render job {job_id} already in progress")
+        return {"job_id": job_id, "status": "pending", "message": "Job already in progress"}
     
-    # Registrar trabajo
-    jobs_status[job_id] = {
+    job = {
         "job_id": job_id,
         "status": "pending",
         "progress": 0,
         "message": "Job queued for processing",
         "created_at": datetime.now().isoformat(),
+        "completed_at": None,
+        "output_file": None,
+        "error": None,
         "video_url": str(request.video_url),
         "audio_url": str(request.audio_url),
         "quality": request.quality
     }
     
-    # Iniciar procesamiento en background
-    background_tasks.add_task(process_render_job, job_id, request)
-    active_jobs += 1
+    try:
+        # Ya renderizado anteriormente: no hace falta volver a procesarlo
+        if await asyncio.to_thread(output_file.exists):
+            job.update({
+                "status": "completed",
+                "progress": 100,
+                "message": "Rendering completed successfully",
+                "completed_at": job["created_at"],
+                "output_file": output_file.name
+            })
+            await save_job(job_id, job)
+            await release_job_claim(job_id, claim_token)
+            
+            logger.info(f"Render job {job_id} served from existing output")
+            return {"job_id": job_id, "status": "completed", "output_file": output_file.name, "message": "Job already completed"}
+        
+        # Registrar trabajo
+        await save_job(job_id, job)
+    
+    except Exception:
+        await release_job_claim(job_id, claim_token)
+        raise
+    
+    # Iniciar procesamiento en background (espera turno si se alcanzó el límite)
+    background_tasks.add_task(process_render_job, job_id, request, claim_token)
     
     logger.info(f"Created render job: {job_id}")
     return {"job_id": job_id, "status": "pending", "message": "Job created successfully"}
 
+def get_render_key(request: RenderRequest) -> str:
+    """Clave determinista de una petición de renderizado"""
+    canonical = json.dumps({
+        "v": str(request.video_url),
+        "a": str(request.audio_url),
+        "q": request.quality
+    }, sort_keys=True)
+    return hashlib.sha256(canonical.encode()).hexdigest()[:16]
+
 @app.get("/status/{job_id}")
 async def get_job_status(job_id: str):
     """Obtener estado de un trabajo"""
-    if job_id not in jobs_status:
+    job = await get_job(job_id)
+    
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
     
-    return jobs_status[job_id]
+    return job
 
 @app.get("/download/{filename}")
 async def download_file(filename: str):
     """Descargar archivo de salida"""
     file_path = OUTPUT_DIR / filename
     
-    if not file_path.exists():
+    # Los archivos ocultos (renders parciales) no se publican
+    if filename.startswith("."):
         raise HTTPException(status_code=404, detail="File not found")
     
+    try:
+        st = await asyncio.to_thread(os.stat, file_path)
+    except OSError:
+        st = None
+    
+    if st is None or not stat.S_ISREG(st.st_mode):
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    # Detrás de nginx: delegar el envío (sendfile) y sacar a Python del camino de datos
+    if X_ACCEL_REDIRECT_PREFIX:
+        return Response(
+            media_type='video/mp4',
+            headers={
+                "X-Accel-Redirect": f"{X_ACCEL_REDIRECT_PREFIX}/{filename}",
+                "Content-Disposition": f'attachment; filename="{filename}"'
+            }
+        )
+    
+    # Reutilizar el stat para Content-Length/ETag sin volver a consultar el disco
     return FileResponse(
         path=str(file_path),
         filename=filename,
-        media_type='video/mp4'
+        media_type='video/mp4',
+        stat_result=st
     )
 
 @app.get("/jobs")
 async def list_jobs():
     """Listar todos los trabajos"""
+    jobs = await get_all_jobs()
+    
     return {
-        "total_jobs": len(jobs_status),
-        "active_jobs": active_jobs,
-        "jobs": list(jobs_status.values())
+        "total_jobs": len(jobs),
+        "active_jobs": count_active_jobs(),
+        "queued_jobs": queued_jobs,
+        "jobs": jobs
     }
 
-async def process_render_job(job_id: str, request: RenderRequest):
+async def process_render_job(job_id: str, request: RenderRequest, claim_token: str):
     """Procesar trabajo de renderizado"""
-    global active_jobs
+    global queued_jobs
     
+    # La espera en cola no debe hacer caducar la reserva del trabajo
+    heartbeat = asyncio.create_task(keep_job_claim(job_id, claim_token))
+    
+    # Esperar un slot libre
+    queued_jobs += 1
     try:
-        # Actualizar estado
-        jobs_status[job_id]["status"] = "processing"
-        jobs_status[job_id]["message"] = "Starting download"
-        jobs_status[job_id]["progress"] = 10
+        await JOB_SEM.acquire()
+    except BaseException:
+        heartbeat.cancel()
+        await release_job_claim(job_id, claim_token)
+        raise
+    finally:
+        queued_jobs -= 1
+    
+    temp_files = []
+    
+    try:
+        # Sale de la cola: renovar la reserva antes de empezar
+        if not await refresh_job_claim(job_id, claim_token):
+            logger.warning(f"Claim on job {job_id} expired while queued")
         
-        # Descargar archivos
-        video_path = await download_file_async(request.video_url, job_id, "video")
-        jobs_status[job_id]["progress"] = 30
+        # Actualizar estado
+        await save_job(job_id, {
+            "status": "processing",
+            "message": "Starting download",
+            "progress": 10
+        })
         
-        audio_path = await download_file_async(request.audio_url, job_id, "audio")
-        jobs_status[job_id]["progress"] = 50
+        if STREAM_INPUTS:
+            # FFmpeg lee directamente las URLs, sin pasar por disco
+            video_input, audio_input = str(request.video_url), str(request.audio_url)
+        else:
+            # Descargar archivos en paralelo
+            temp_files = await gather_or_cancel(
+                download_file_async(request.video_url, job_id, "video"),
+                download_file_async(request.audio_url, job_id, "audio")
+            )
+            video_input, audio_input = (str(path) for path in temp_files)
         
         # Renderizar video
-        jobs_status[job_id]["message"] = "Processing video"
-        output_path = await render_video(video_path, audio_path, job_id, request.quality)
-        jobs_status[job_id]["progress"] = 90
+        await save_job(job_id, {"progress": 50, "message": "Processing video"})
+        output_path = await render_video(video_input, audio_input, job_id, request.quality)
+        await save_job(job_id, {"progress": 90})
         
         # Completar trabajo
-        jobs_status[job_id].update({
+        await save_job(job_id, {
             "status": "completed",
             "progress": 100,
             "message": "Rendering completed successfully",
@@ -198,7 +576,7 @@ async def process_render_job(job_id: str, request: RenderRequest):
         })
         
         # Limpiar archivos temporales
-        cleanup_temp_files([video_path, audio_path])
+        await cleanup_temp_files(temp_files)
         
         logger.info(f"Job {job_id} completed successfully")
         
@@ -206,7 +584,10 @@ async def process_render_job(job_id: str, request: RenderRequest):
         error_msg = str(e)
         logger.error(f"Job {job_id} failed: {error_msg}")
         
-        jobs_status[job_id].update({
+        # Incluye descargas incompletas o canceladas, cuyas rutas no llegaron a devolverse
+        await cleanup_temp_files(await asyncio.to_thread(lambda: list(TEMP_DIR.glob(f"{job_id}_*"))))
+        
+        await save_job(job_id, {
             "status": "failed",
             "message": f"Rendering failed: {error_msg}",
             "error": error_msg,
@@ -214,28 +595,53 @@ async def process_render_job(job_id: str, request: RenderRequest):
         })
     
     finally:
-        active_jobs -= 1
+        JOB_SEM.release()
+        heartbeat.cancel()
+        await release_job_claim(job_id, claim_token)
+
+async def gather_or_cancel(*coros) -> list:
+    """Como asyncio.gather, pero cancela las tareas restantes si una falla"""
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        # Sin esto las demás seguirían escribiendo y reteniendo buffers del pool
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
 
 async def download_file_async(url: HttpUrl, job_id: str, file_type: str) -> Path:
     """Descargar archivo de forma asíncrona"""
+    timeout = aiohttp.ClientTimeout(total=600)
+    
     try:
-        response = requests.get(str(url), stream=True, timeout=60)
-        response.raise_for_status()
+        # Consultar tamaño y soporte de Range antes de descargar
+        size = 0
+        accepts_ranges = False
+        content_type = ''
+        try:
+            async with http_session.head(str(url), timeout=timeout, allow_redirects=True) as head:
+                if head.status < 400:
+                    size = int(head.headers.get('content-length', 0))
+                    accepts_ranges = head.headers.get('accept-ranges', '').lower() == 'bytes'
+                    content_type = head.headers.get('content-type', '')
+        except (aiohttp.ClientError, ValueError):
+            pass
         
-        # Determinar extensión basada en content-type o URL
-        content_type = response.headers.get('content-type', '')
-        if file_type == "video":
-            extension = ".mp4"
-        elif file_type == "audio":
-            extension = ".wav" if "wav" in content_type or str(url).endswith(".wav") else ".mp3"
+        if accepts_ranges and size > RANGE_DOWNLOAD_THRESHOLD:
+            file_path = TEMP_DIR / f"{job_id}_{file_type}{get_file_extension(url, file_type, content_type)}"
+            await download_ranges(str(url), file_path, size, timeout)
         else:
-            extension = ""
-            
-        file_path = TEMP_DIR / f"{job_id}_{file_type}{extension}"
-        
-        async with aiofiles.open(file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                await f.write(chunk)
+            async with http_session.get(str(url), timeout=timeout) as response:
+                response.raise_for_status()
+                
+                content_type = response.headers.get('content-type', '')
+                file_path = TEMP_DIR / f"{job_id}_{file_type}{get_file_extension(url, file_type, content_type)}"
+                
+                async with aiofiles.open(file_path, 'wb') as f:
+                    await copy_stream_to_file(response.content, f)
         
         logger.info(f"Downloaded {file_type} for job {job_id}: {file_path}")
         return file_path
@@ -243,31 +649,150 @@ async def download_file_async(url: HttpUrl, job_id: str, file_type: str) -> Path
     except Exception as e:
         raise Exception(f"Failed to download {file_type}: {str(e)}")
 
-async def render_video(video_path: Path, audio_path: Path, job_id: str, quality: str) -> Path:
+def get_file_extension(url: HttpUrl, file_type: str, content_type: str) -> str:
+    """Determinar extensión basada en content-type o URL"""
+    if file_type == "video":
+        return ".mp4"
+    elif file_type == "audio":
+        return ".wav" if "wav" in content_type or str(url).endswith(".wav") else ".mp3"
+    return ""
+
+async def download_ranges(url: str, file_path: Path, size: int, timeout: aiohttp.ClientTimeout):
+    """Descargar un archivo en partes paralelas con peticiones Range"""
+    # Reservar el tamaño final para que cada parte escriba en su offset
+    async with aiofiles.open(file_path, 'wb') as f:
+        await f.truncate(size)
+    
+    part_size = -(-size // RANGE_DOWNLOAD_PARTS)
+    
+    async def download_part(start: int):
+        end = min(start + part_size, size) - 1
+        headers = {"Range": f"bytes={start}-{end}"}
+        
+        async with http_session.get(url, headers=headers, timeout=timeout) as response:
+            response.raise_for_status()
+            if response.status != 206:
+                raise Exception("Server ignored Range request")
+            
+            async with aiofiles.open(file_path, 'r+b') as f:
+                await f.seek(start)
+                written = await copy_stream_to_file(response.content, f)
+        
+        if written != end - start + 1:
+            raise Exception(f"Incomplete range {start}-{end}: got {written} bytes")
+    
+    await gather_or_cancel(*[download_part(start) for start in range(0, size, part_size)])
+
+async def copy_stream_to_file(stream: aiohttp.StreamReader, f) -> int:
+    """Copiar un stream HTTP a un archivo agrupando las escrituras en un buffer del pool"""
+    buffer = await BUFFER_POOL.get()
+    view = memoryview(buffer)
+    total = 0
+    filled = 0
+    
+    try:
+        while True:
+            # Leer como máximo lo que falta para llenar el buffer
+            data = await stream.read(DOWNLOAD_BUFFER_SIZE - filled)
+            if not data:
+                break
+            
+            view[filled:filled + len(data)] = data
+            filled += len(data)
+            
+            if filled == DOWNLOAD_BUFFER_SIZE:
+                await f.write(view)
+                total += filled
+                filled = 0
+        
+        if filled:
+            await f.write(view[:filled])
+            total += filled
+        
+        return total
+    
+    finally:
+        view.release()
+        BUFFER_POOL.put_nowait(buffer)
+
+async def render_video(video_input: str, audio_input: str, job_id: str, quality: str) -> Path:
     """Renderizar video con audio usando FFmpeg"""
+    global inprocess_remux
+    
     output_file = OUTPUT_DIR / f"render_{job_id}.mp4"
     
+    # Escribir a un archivo parcial y renombrarlo al terminar, para que nunca se
+    # sirva (ni se reutilice como caché) un render incompleto
+    partial_file = OUTPUT_DIR / f".render_{job_id}.partial.mp4"
+    
     # Configuración de calidad
-    quality_settings = {
-        "high": ["-crf", "18", "-preset", "medium"],
-        "medium": ["-crf", "23", "-preset", "fast"], 
-        "low": ["-crf", "28", "-preset", "ultrafast"]
-    }
+    quality_settings = ENCODER_SETTINGS[video_encoder]
+    
+    # Si los streams ya están en H.264/AAC basta con copiarlos (sin re-codificar)
+    video_info, audio_info = await asyncio.gather(
+        probe_media(video_input, "v:0", "stream=codec_name,width,height:format=duration"),
+        probe_media(audio_input, "a:0", "stream=codec_name")
+    )
+    video_streams = video_info.get("streams") or [{}]
+    audio_streams = audio_info.get("streams") or [{}]
+    copy_video = video_streams[0].get("codec_name") == "h264"
+    copy_audio = audio_streams[0].get("codec_name") == "aac"
+    
+    try:
+        duration = float(video_info.get("format", {}).get("duration", 0))
+    except (TypeError, ValueError):
+        duration = 0.0
+    
+    if copy_video:
+        video_settings = ["-c:v", "copy"]
+    else:
+        video_settings = list(quality_settings.get(quality, quality_settings["medium"]))
+        
+        # Los encoders por hardware no usan hilos de CPU
+        if video_encoder == "libx264":
+            video_settings = tune_x264_settings(video_settings, video_streams[0].get("height"))
+    
+    if copy_audio:
+        audio_settings = ["-c:a", "copy"]
+    else:
+        audio_settings = ["-c:a", "aac", "-b:a", "192k"]
+    
+    # Solo copia de streams: remux dentro del proceso con PyAV, sin lanzar ffmpeg
+    if inprocess_remux and copy_video and copy_audio:
+        try:
+            await asyncio.to_thread(remux_streams, video_input, audio_input, partial_file)
+            await asyncio.to_thread(os.replace, partial_file, output_file)
+            
+            logger.info(f"Video remux completed in-process for job {job_id}")
+            return output_file
+        
+        except av.FFmpegError as e:
+            # Error del contenido (entrada inesperada): este trabajo lo resuelve ffmpeg
+            logger.warning(f"In-process remux failed for job {job_id}, falling back to FFmpeg: {e}")
+            await cleanup_temp_files([partial_file])
+        
+        except Exception:
+            # Error del propio código o de PyAV: desactivarlo en vez de pagarlo en cada trabajo
+            logger.exception(f"In-process remux broken, disabling it (job {job_id} falls back to FFmpeg)")
+            inprocess_remux = False
+            await cleanup_temp_files([partial_file])
     
     # Comando FFmpeg
     cmd = [
         "ffmpeg", "-y",
-        "-i", str(video_path),
-        "-i", str(audio_path),
-        "-c:v", "libx264",
-        "-c:a", "aac",
-        "-threads", str(FFMPEG_THREADS),
-        *quality_settings.get(quality, quality_settings["medium"]),
-        "-movflags", "+faststart",
-        str(output_file)
+        "-fflags", "+genpts",
+        *([] if copy_video else ENCODER_INPUT_ARGS.get(video_encoder, [])),
+        *input_args(video_input), "-i", video_input,
+        *input_args(audio_input), "-i", audio_input,
+        "-map", "0:v:0", "-map", "1:a:0",
+        *video_settings,
+        *audio_settings,
+        "-movflags", MP4_MOVFLAGS,
+        "-progress", "pipe:1", "-nostats",
+        str(partial_file)
     ]
     
-    logger.info(f"Starting FFmpeg render for job {job_id}")
+    logger.info(f"Starting FFmpeg render for job {job_id} (video {'copy' if copy_video else 'encode'}, audio {'copy' if copy_audio else 'encode'})")
     
     # Ejecutar FFmpeg
     process = await asyncio.create_subprocess_exec(
@@ -276,27 +801,213 @@ async def render_video(video_path: Path, audio_path: Path, job_id: str, quality:
         stderr=asyncio.subprocess.PIPE
     )
     
-    stdout, stderr = await process.communicate()
+    # Leer stderr en paralelo para que el pipe no se bloquee
+    stderr_task = asyncio.create_task(process.stderr.read())
+    try:
+        await track_render_progress(process.stdout, job_id, duration)
+        await process.wait()
+        stderr = await stderr_task
+    except BaseException:
+        # Error al guardar el progreso o cancelación: no dejar ffmpeg huérfano
+        # bloqueado en un stdout que ya nadie lee
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+        await process.wait()
+        stderr_task.cancel()
+        await cleanup_temp_files([partial_file])
+        raise
     
     if process.returncode != 0:
         error_msg = stderr.decode('utf-8')
         logger.error(f"FFmpeg error for job {job_id}: {error_msg}")
+        await cleanup_temp_files([partial_file])
         raise Exception(f"FFmpeg rendering failed: {error_msg}")
     
-    if not output_file.exists():
+    if not partial_file.exists():
         raise Exception("Output file was not created")
     
+    await asyncio.to_thread(os.replace, partial_file, output_file)
+    
     logger.info(f"Video rendering completed for job {job_id}")
     return output_file
 
-def cleanup_temp_files(file_paths: list):
-    """Limpiar archivos temporales"""
-    for path in file_paths:
+def remux_streams(video_input: str, audio_input: str, output_file: Path):
+    """Combinar video y audio sin re-codificar usando PyAV"""
+    def open_options(source: str) -> Dict[str, str]:
+        args = input_args(source)
+        return {key.lstrip('-'): value for key, value in zip(args[::2], args[1::2])}
+    
+    def timed_packets(container, in_stream, out_stream):
+        for packet in container.demux(in_stream):
+            # Los paquetes de flush no tienen timestamp
+            if packet.dts is None:
+                continue
+            yield float(packet.dts * packet.time_base), packet, out_stream
+    
+    with av.open(video_input, options=open_options(video_input)) as video_container, \
+         av.open(audio_input, options=open_options(audio_input)) as audio_container, \
+         av.open(str(output_file), mode="w", format="mp4", options={"movflags": MP4_MOVFLAGS}) as output:
+        
+        in_video = video_container.streams.video[0]
+        in_audio = audio_container.streams.audio[0]
+        out_video = output.add_stream_from_template(in_video)
+        out_audio = output.add_stream_from_template(in_audio)
+        
+        # Intercalar video y audio por tiempo, igual que haría ffmpeg
+        for _, packet, out_stream in heapq.merge(
+            timed_packets(video_container, in_video, out_video),
+            timed_packets(audio_container, in_audio, out_audio),
+            key=lambda item: item[0]
+        ):
+            packet.stream = out_stream
+            output.mux(packet)
+
+def check_inprocess_remux() -> bool:
+    """Verificar que el remux con PyAV funciona, combinando un clip sintético"""
+    if av is None:
+        return False
+    
+    try:
+        with tempfile.TemporaryDirectory(dir=TEMP_DIR) as tmp:
+            video_file = Path(tmp) / "video.mp4"
+            audio_file = Path(tmp) / "audio.m4a"
+            output_file = Path(tmp) / "output.mp4"
+            
+            with av.open(str(video_file), mode="w") as container:
+                stream = container.add_stream("libx264", rate=1)
+                stream.width, stream.height, stream.pix_fmt = 64, 64, "yuv420p"
+                frame = av.VideoFrame(64, 64, "yuv420p")
+                frame.pts = 0
+                container.mux(stream.encode(frame))
+                container.mux(stream.encode())
+            
+            with av.open(str(audio_file), mode="w") as container:
+                stream = container.add_stream("aac", rate=44100)
+                frame = av.AudioFrame(format="fltp", layout="stereo", samples=1024)
+                frame.sample_rate, frame.pts = 44100, 0
+                for plane in frame.planes:
+                    plane.update(bytes(plane.buffer_size))
+                container.mux(stream.encode(frame))
+                container.mux(stream.encode())
+            
+            remux_streams(str(video_file), str(audio_file), output_file)
+            
+            with av.open(str(output_file)) as container:
+                return len(container.streams.video) == 1 and len(container.streams.audio) == 1
+    
+    except Exception:
+        logger.exception("In-process remux self-test failed")
+        return False
+
+def tune_x264_settings(settings: list, height: Optional[int]) -> list:
+    """Ajustar preset, hilos y parámetros de libx264 según la resolución de entrada"""
+    if not height:
+        return settings + ["-threads", str(FFMPEG_THREADS)]
+    
+    tuned = list(settings)
+    
+    if height >= 2160:
+        # En 4K, dos presets más rápido que el de la calidad pedida; nunca más lento
+        preset_index = tuned.index("-preset") + 1
+        position = X264_PRESETS.index(tuned[preset_index])
+        tuned[preset_index] = X264_PRESETS[max(position - 2, 0)]
+        # Más hilos en 4K, pero nunca menos que en resoluciones inferiores
+        threads = max(FFMPEG_THREADS, min(FFMPEG_THREADS * 2, 8))
+        x264_params = "rc-lookahead=20"
+    elif height >= 1080:
+        threads, x264_params = FFMPEG_THREADS, "rc-lookahead=20"
+    else:
+        threads, x264_params = FFMPEG_THREADS, "aq-mode=2"
+    
+    return tuned + ["-threads", str(threads), "-x264-params", x264_params]
+
+def input_args(source: str) -> list:
+    """Opciones de FFmpeg que deben ir antes de cada -i"""
+    # Análisis de entrada reducido
+    args = ["-analyzeduration", "1000000", "-probesize", "1000000"]
+    
+    # Reconectar si se cae la conexión al leer una URL
+    if source.startswith(("http://", "https://")):
+        args += ["-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5"]
+    
+    return args
+
+async def track_render_progress(stream: asyncio.StreamReader, job_id: str, duration: float):
+    """Actualizar el progreso del trabajo con la salida -progress de FFmpeg"""
+    last_progress = 50
+    
+    async for line in stream:
+        key, _, value = line.decode('utf-8', errors='replace').strip().partition("=")
+        if key != "out_time_us" or duration <= 0:
+            continue
+        
         try:
-            if path and path.exists():
-                path.unlink()
-        except Exception as e:
-            logger.warning(f"Failed to cleanup {path}: {e}")
+            seconds = int(value) / 1_000_000
+        except ValueError:
+            continue
+        
+        # El render ocupa el tramo 50-90 del progreso total
+        progress = 50 + int(40 * min(seconds / duration, 1.0))
+        if progress > last_progress:
+            last_progress = progress
+            await save_job(job_id, {"progress": progress})
+
+async def probe_media(source: str, stream: str, entries: str) -> Dict[str, Any]:
+    """Obtener información de un stream con ffprobe"""
+    process = await asyncio.create_subprocess_exec(
+        "ffprobe", "-v", "error",
+        "-select_streams", stream,
+        "-show_entries", entries,
+        "-of", "json",
+        source,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    
+    stdout, stderr = await process.communicate()
+    
+    if process.returncode != 0:
+        logger.warning(f"ffprobe failed for {source}: {stderr.decode('utf-8').strip()}")
+        return {}
+    
+    try:
+        return json.loads(stdout)
+    except ValueError:
+        return {}
+
+async def cleanup_temp_files(file_paths: list):
+    """Limpiar archivos temporales"""
+    paths = [path for path in file_paths if path]
+    results = await asyncio.gather(
+        *[aiofiles.os.remove(str(path)) for path in paths],
+        return_exceptions=True
+    )
+    
+    for path, result in zip(paths, results):
+        if isinstance(result, Exception) and not isinstance(result, FileNotFoundError):
+            logger.warning(f"Failed to cleanup {path}: {result}")
+
+async def cleanup_orphan_temp_files():
+    """Eliminar temporales y renders parciales antiguos de trabajos fallidos o reinicios"""
+    cutoff = time.time() - TEMP_FILE_MAX_AGE_HOURS * 3600
+    
+    def find_orphans() -> list:
+        candidates = list(TEMP_DIR.iterdir()) + list(OUTPUT_DIR.glob(".render_*.partial.mp4"))
+        orphans = []
+        for path in candidates:
+            try:
+                if path.is_file() and path.stat().st_mtime < cutoff:
+                    orphans.append(path)
+            except OSError:
+                continue
+        return orphans
+    
+    orphans = await asyncio.to_thread(find_orphans)
+    if orphans:
+        logger.info(f"Removing {len(orphans)} orphaned temp files")
+        await cleanup_temp_files(orphans)
 
 if __name__ == "__main__":
     import uvicorn